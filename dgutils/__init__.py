@@ -1,6 +1,13 @@
-from . import fonts
-from . import colors
-from . import savehtml
-from . import pypov
-from . import nb 
+import importlib
 
+# the submodules are imported the first time they are used, so scripts only
+# pay for the ones they need
+__all__ = ['fonts', 'colors', 'savehtml', 'pypov', 'nb']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
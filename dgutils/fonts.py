@@ -1,40 +1,182 @@
 # Helper utilties for dealing with local fonts in matplotlib
 
-import matplotlib as mpl
-import matplotlib.font_manager as fm
+# matplotlib is imported when a font is first used
 import os
+import dataclasses
+from collections import OrderedDict
+
+# the font files register_fonts picks up from a directory
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+
+# fonts registered with matplotlib:
+# (real path, name, faces) -> (mtime, FontEntry)
+_registry = {}
+
+# -----------------------------------------------------------------
+def _register(font_path, name=None, faces=True):
+    '''Add a font file to the front of matplotlib's font list, unless the
+       same version of the file is already there.  Returns its FontEntry
+       (None if it can't be read) and what was done: 'added', 'replaced'
+       or None.
+       faces : read the weight and style from the file; otherwise the font
+               is registered as the normal face of name.
+    '''
+    import matplotlib.font_manager as fm
+    from matplotlib.ft2font import FT2Font
+
+    path = os.path.realpath(font_path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, None
+
+    key = (path, name, faces)
+    old = _registry.get(key)
+    if old is not None and old[0] == mtime:
+        return old[1], None
+
+    if not faces:
+        entry = fm.FontEntry(fname=path, name=name)
+    else:
+        try:
+            entry = fm.ttfFontProperty(FT2Font(path))
+        except (OSError, RuntimeError):
+            return None, None
+        if name is not None:
+            entry = dataclasses.replace(entry, name=name)
+
+    # a font file which has changed replaces its old entry
+    if old is not None and old[1] in fm.fontManager.ttflist:
+        fm.fontManager.ttflist.remove(old[1])
+    fm.fontManager.ttflist.insert(0, entry)
+    _registry[key] = (mtime, entry)
+    return entry, 'added' if old is None else 'replaced'
+
+def _clear_font_caches(reload=False):
+    '''Make matplotlib look up fonts again after the font list changed.
+       reload : also drop the loaded font files (when some have changed).
+    '''
+    import matplotlib.font_manager as fm
+
+    findfont = getattr(fm.fontManager, '_findfont_cached', None)
+    if hasattr(findfont, 'cache_clear'):
+        findfont.cache_clear()
+    if reload and hasattr(getattr(fm, '_get_font', None), 'cache_clear'):
+        fm._get_font.cache_clear()
+
+def register_fonts(font_path, name=None, recursive=False):
+    '''Register a font file, or all the font files in a directory, with
+       matplotlib.  Each file is only added once; if it has changed since
+       it was registered, its old entry is replaced.  Returns the FontEntry
+       of every font that was found.
+
+       font_path : a .ttf/.otf file or a directory of them.
+       name : the family name to register the fonts under; by default each
+              font keeps its own.  Bold, italic and other faces keep their
+              weight and style, so a directory registered under one name
+              becomes one family.
+       recursive : also register the fonts in subdirectories.
+    '''
+
+    if os.path.isdir(font_path):
+        paths = []
+        for root, dirs, files in os.walk(font_path):
+            paths += [os.path.join(root, f) for f in sorted(files)
+                      if f.lower().endswith(FONT_EXTENSIONS)]
+            if not recursive:
+                break
+    else:
+        paths = [font_path]
+
+    entries = []
+    done = set()
+    for path in paths:
+        entry, action = _register(path, name)
+        if entry is not None:
+            entries.append(entry)
+            done.add(action)
+
+    # the caches are cleared once for the whole batch
+    if done - {None}:
+        _clear_font_caches(reload='replaced' in done)
+    return entries
 
 # -----------------------------------------------------------------
 def set_custom_font(font_path, name='custom', labelweight='light'):
     '''Set a custom font to be used for plotting in matplotlib.
-       font_path : the full path to a .ttf font file.
+       font_path : the full path to a .ttf font file, or a directory of
+                   font files (regular, bold, italic, ...) which are used
+                   together as one family.  A single file is used for
+                   every weight and style.
     '''
-    
-    if os.path.isfile(font_path):
-        fe = fm.FontEntry(fname=font_path,name=name)
-        fm.fontManager.ttflist.insert(0, fe) 
+    import matplotlib as mpl
 
-        mpl.rcParams['font.family'] = fe.name
+    if os.path.isdir(font_path):
+        found = register_fonts(font_path, name)
+    else:
+        entry, action = _register(font_path, name, faces=False)
+        if action is not None:
+            _clear_font_caches(reload=action == 'replaced')
+        found = entry is not None
+
+    if found:
+        mpl.rcParams['font.family'] = name
         mpl.rcParams['mathtext.fontset'] = 'custom'
-        mpl.rcParams['mathtext.rm'] = f'{fe.name}:regular'
-        mpl.rcParams['mathtext.it'] = f'{fe.name}:italic'
-        mpl.rcParams['mathtext.bf'] = f'{fe.name}:bold'
-        mpl.rcParams['mathtext.sf'] = f'{fe.name}:sans'
-        mpl.rcParams['mathtext.tt'] = f'{fe.name}:monospace'
+        mpl.rcParams['mathtext.rm'] = f'{name}:regular'
+        mpl.rcParams['mathtext.it'] = f'{name}:italic'
+        mpl.rcParams['mathtext.bf'] = f'{name}:bold'
+        mpl.rcParams['mathtext.sf'] = name
+        mpl.rcParams['mathtext.tt'] = name
         mpl.rcParams['axes.labelweight'] = labelweight
-        mpl.rcParams['font.sans-serif'] = fe.name
+        mpl.rcParams['font.sans-serif'] = name
     else:
         print(f'Font: {font_path} not found\n')
 
 # -----------------------------------------------------------------
-def get_custom_font_props(font_path):
+# the FontProperties handed out by get_custom_font_props, least recently
+# used first: (real path, size, weight) -> FontProperties
+FONT_PROPS_POOL_SIZE = 256
+_font_props = OrderedDict()
+
+def get_custom_font_props(font_path, size=None, weight=None):
     '''Get a custon font properties object based on a user supplied
-       font path.
+       font path.  Each call returns a new copy of a pooled object, so
+       the font file isn't read again and callers can change it freely.
 
        font_path : the full path to a .ttf font file.
+       size, weight : the font size and weight (default: from rcParams).
     '''
+    import matplotlib.font_manager as fm
+
+    key = (os.path.realpath(font_path), size, weight)
+    props = _font_props.get(key)
+    if props is not None:
+        _font_props.move_to_end(key)
+        return props.copy()
 
     if os.path.isfile(font_path):
-        return fm.FontProperties(fname=font_path)
+        props = _font_props[key] = fm.FontProperties(fname=font_path, size=size,
+                                                     weight=weight)
+        while len(_font_props) > FONT_PROPS_POOL_SIZE:
+            _font_props.popitem(last=False)
+        return props.copy()
     else:
         print(f'Font: {font_path} not found\n')
+
+def warm_font_props(font_paths, sizes=(None,), weights=(None,)):
+    '''Load fonts ahead of time (e.g. when a process starts): each font
+       file is parsed once and the properties for every size and weight are
+       added to the pool used by get_custom_font_props.
+
+       font_paths : a font file or a list of them.
+    '''
+    import matplotlib.font_manager as fm
+
+    if isinstance(font_paths, (str, os.PathLike)):
+        font_paths = [font_paths]
+    for font_path in font_paths:
+        if os.path.isfile(font_path):
+            fm.get_font(font_path)
+        for size in sizes:
+            for weight in weights:
+                get_custom_font_props(font_path, size, weight)
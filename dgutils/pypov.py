@@ -1,60 +1,87 @@
-import sys, os
+import sys, os, io, re, json
 
 from math import *
 
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
 import subprocess 
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from .colors import hex_to_rgb
 import numpy as np
-from PIL import Image
 
 # -----------------------------------------------------------------------------------
-def sweep(start,end,num_points,rad,color='#6bff2b',transmit=0.8):
-    ''' Return a sphere_sweep object.'''
+def _sweep_text(path,rad,color,transmit):
+    ''' Return a sphere_sweep object through the points of path, formatting all
+    the points at once. '''
 
     # bond color
     bond_color = hex_to_rgb(color)
 
+    path = np.asarray(path,dtype=float).reshape(-1,3)
+    rad = np.broadcast_to(np.asarray(rad,dtype=float),(len(path),))
+
+    sweep = 'sphere_sweep {\n linear_spline\n%d,\n' % len(path)
+    sweep += ''.join(_format_rows('<%f,%f,%f>, %f\n',path,rad))
+    sweep += 'texture {finish {ambient 1}\n pigment { color rgb <%f,%f,%f>\n transmit %f\n} }\n' % (*bond_color,transmit)
+    sweep += '}\n\n'
+
+    return sweep
+
+# -----------------------------------------------------------------------------------
+def sweep(start,end,num_points,rad,color='#6bff2b',transmit=0.8):
+    ''' Return a sphere_sweep object.'''
+
     # generate the points
     v = np.array(end) - np.array(start)
     dv = v/num_points
-    midpoint = start + 0.5*dv
+    n = np.arange(num_points+1)
+    path = start + dv*n[:,np.newaxis]
 
     min_rad = 0.1*rad
     max_rad = 2.0*(rad-min_rad)/num_points
+    rads = max_rad*np.abs(n-0.5*num_points)+min_rad
 
-    path = []
-    rads = []
-    for n in range(num_points+1):
-        path.append(list(start + dv*n))
-        rads.append(max_rad*np.abs(n-0.5*num_points)+min_rad)
-
-    sweep = 'sphere_sweep {\n linear_spline\n%d,\n' % len(path)
-    for n in range(num_points+1):
-        x,y,z = path[n]
-        sweep +=  '<%f,%f,%f>, %f\n' % (*path[n],rads[n])
-    sweep += 'texture {finish {ambient 1}\n pigment { color rgb <%f,%f,%f>\n transmit %f\n} }\n' % (*bond_color,transmit)
-    sweep += '}\n\n'
-
-    return sweep
+    return _sweep_text(path,rads,color,transmit)
 
 # -----------------------------------------------------------------------------------
 def sweep_from_path(path,rad,color='#6bff2b',transmit=0.8):
     ''' Return a sphere_sweep object for the given path.'''
 
-    # bond color
-    bond_color = hex_to_rgb(color)
+    return _sweep_text(path,rad,color,transmit)
 
-    if not isinstance(rad,(list,)):
-        rad = rad*np.ones(len(path))
+# -----------------------------------------------------------------------------------
+def sweeps_from_paths(paths,rad,color='#6bff2b',transmit=0.8,per_path=()):
+    ''' Return the sphere_sweep objects for a list of paths.
 
-    sweep = 'sphere_sweep {\n linear_spline\n%d,\n' % len(path)
-    for n in range(len(path)):
-        x,y,z = path[n]
-        sweep +=  '<%f,%f,%f>, %f\n' % (*path[n],rad[n])
-    sweep += 'texture {finish {ambient 1}\n pigment { color rgb <%f,%f,%f>\n transmit %f\n} }\n' % (*bond_color,transmit)
-    sweep += '}\n\n'
+    rad, color, transmit : used for every path, unless named in per_path;
+                           rad may be a single radius or one per point.
+    per_path : the names of the arguments ('rad', 'color', 'transmit')
+               which hold one value per path (a list, tuple or array of
+               len(paths) values), or True for all of them.
+    '''
 
-    return sweep
+    if per_path is True:
+        per_path = ('rad','color','transmit')
+    unknown = set(per_path) - {'rad','color','transmit'}
+    if unknown:
+        raise ValueError('unknown per_path arguments: %s'%', '.join(sorted(unknown)))
+
+    values = {'rad': rad, 'color': color, 'transmit': transmit}
+    for name,value in values.items():
+        if name in per_path:
+            value = list(value)
+            if len(value) != len(paths):
+                raise ValueError('%s has %d values for %d paths'%(name,len(value),len(paths)))
+            values[name] = value
+        else:
+            values[name] = [value]*len(paths)
+
+    return ''.join([_sweep_text(*args) for args in
+                    zip(paths,values['rad'],values['color'],values['transmit'])])
 
 # ----------------------------------------------------------------------------
 def linear(r1,r2):
@@ -89,9 +116,305 @@ def get_color(color, transmit=0.0):
     return color_string
 
 # -----------------------------------------------------------------------------------
-def pov_run(pov_file,width=1024,height=1,res="low",auto_crop=False):
-    
-    low_res = ["-p"]
+def povray_command():
+    ''' Return the povray binary and its options file as a command list.
+
+    The binary is taken from the POVRAY environment variable, then
+    $HOME/local/bin/povray and then the PATH.  The options file is
+    POVRAY_INI or $HOME/.povray/3.7/povray.ini, if it exists. '''
+
+    HOME = os.path.expanduser('~')
+    povcmd = os.environ.get('POVRAY')
+    if not povcmd:
+        povcmd = f'{HOME}/local/bin/povray'
+        if not os.path.isfile(povcmd):
+            povcmd = shutil.which('povray') or 'povray'
+    povopts = os.environ.get('POVRAY_INI',f'{HOME}/.povray/3.7/povray.ini')
+
+    cmd = [povcmd]
+    if os.path.isfile(povopts):
+        cmd.append(povopts)
+    return cmd
+
+# -----------------------------------------------------------------------------------
+def _scene_hash(pov_file,hash_=None,seen=None):
+    ''' Hash the text of pov_file and of the local files it #includes. '''
+    if hash_ is None:
+        hash_,seen = hashlib.sha256(),set()
+    seen.add(os.path.abspath(pov_file))
+
+    with open(pov_file,'rb') as f:
+        text = f.read()
+    hash_.update(text)
+
+    # standard includes (colors.inc, ...) aren't local and only their name counts
+    directory = os.path.dirname(os.path.abspath(pov_file))
+    for name in re.findall(rb'#include\s+"([^"]+)"',text):
+        include = os.path.join(directory,name.decode())
+        if os.path.isfile(include) and os.path.abspath(include) not in seen:
+            _scene_hash(include,hash_,seen)
+
+    return hash_
+
+def _cache_evict(cache_dir,cache_size):
+    ''' Remove the least recently used renders until cache_dir holds at most
+    cache_size bytes.  Other renders may evict the same files at the same
+    time, so files which have already gone are skipped. '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.png'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,entry.path))
+    entries.sort()
+    total = sum(size for _,size,_ in entries)
+    for _,size,path in entries:
+        if total <= cache_size:
+            break
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# -----------------------------------------------------------------------------------
+def image_bbox(pixels,background=None,tol=0):
+    ''' Return the bounding box (left, upper, right, lower) of the pixels of
+    an image array which differ from the background by more than tol in some
+    channel, or None if there are none.
+
+    background : a hex color or tuple of channel values in [0,255]; by
+                 default (like PIL's getbbox) transparent pixels, or black
+                 ones for images without alpha.
+    '''
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[...,np.newaxis]
+
+    if background is None:
+        channels = pixels[...,3:] if pixels.shape[2] == 4 else pixels
+        foreground = np.any(channels > tol,axis=2)
+    else:
+        if type(background) == str:
+            background = hex_to_rgb(background,full=True)
+        background = np.asarray(background,dtype=int)
+        difference = pixels[...,:len(background)].astype(int) - background
+        foreground = np.any(np.abs(difference) > tol,axis=2)
+
+    rows = np.flatnonzero(foreground.any(axis=1))
+    if not rows.size:
+        return None
+    cols = np.flatnonzero(foreground.any(axis=0))
+    return (int(cols[0]),int(rows[0]),int(cols[-1])+1,int(rows[-1])+1)
+
+def crop_images(png_files,background=None,tol=0,shared=False,jobs=None):
+    ''' Crop each image to the bounding box of its content (see image_bbox)
+    and return the boxes.  With shared=True every image is cropped to the
+    union of all the boxes, so the frames of an animation keep the same
+    size.  Images are processed on jobs threads. '''
+    from PIL import Image
+
+    def bbox(png_file):
+        with Image.open(png_file) as image:
+            return image_bbox(np.asarray(image),background,tol)
+
+    def crop(png_file,box):
+        with Image.open(png_file) as image:
+            if box is None or box == (0,0) + image.size:
+                return
+            cropped = image.crop(box)
+        cropped.save(png_file)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        boxes = list(pool.map(bbox,png_files))
+        if shared:
+            found = [box for box in boxes if box is not None]
+            if found:
+                left,upper,right,lower = zip(*found)
+                box = (min(left),min(upper),max(right),max(lower))
+            else:
+                box = None
+            boxes = [box]*len(boxes)
+        list(pool.map(crop,png_files,boxes))
+
+    return boxes
+
+# -----------------------------------------------------------------------------------
+# seconds between refreshes of the lock of a tile being rendered, and after
+# which the lock of a worker that stopped refreshing it is reclaimed
+TILE_LOCK_REFRESH = 10
+TILE_LOCK_TIMEOUT = 60
+
+def _tile_lock_stale(lock):
+    ''' Whether the worker holding a tile lock has gone: its process has
+    exited (if it ran on this host) or it hasn't refreshed the lock for
+    TILE_LOCK_TIMEOUT seconds. '''
+    try:
+        age = time.time() - os.path.getmtime(lock)
+        with open(lock) as f:
+            owner = json.loads(f.read() or '{}')
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        owner = {}
+
+    if owner.get('host') == socket.gethostname() and 'pid' in owner:
+        try:
+            os.kill(owner['pid'],0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return age > TILE_LOCK_TIMEOUT
+
+def render_tiles(job_dir,jobs=1,threads=None,quiet=True):
+    ''' Render the tiles of a tiled render (see pov_run) which haven't been
+    claimed yet, running up to jobs povray processes at once.  This can also
+    be run on other nodes which share job_dir to help with the render. '''
+
+    with open(os.path.join(job_dir,'tiles.json')) as f:
+        spec = json.load(f)
+
+    output = subprocess.DEVNULL if quiet else None
+    def render(tile):
+        # claim the tile, unless another process already has
+        lock = tile['output'] + '.lock'
+        try:
+            fd = os.open(lock,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except FileExistsError:
+            return
+        with os.fdopen(fd,'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid()},f)
+
+        pov_opts = spec['options'] + tile['options'] + ['+O' + tile['output']]
+        if threads:
+            pov_opts.append("+WT%d"%threads)
+        povray = subprocess.Popen(povray_command() + pov_opts + [spec['pov_file']],
+                                  stdout=output,stderr=output)
+
+        # keep the lock fresh so the tile isn't reclaimed while it renders
+        while True:
+            try:
+                status = povray.wait(timeout=TILE_LOCK_REFRESH)
+                break
+            except subprocess.TimeoutExpired:
+                try:
+                    os.utime(lock)
+                except FileNotFoundError:
+                    pass
+        with open(tile['output'] + '.done','w') as f:
+            f.write(str(status))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(render,spec['tiles']))
+
+def _render_tiled(pov_file,pov_opts,png_name,width,height,tiles,tile_axis,jobs,
+                  job_dir,threads,quiet):
+    ''' Render pov_file as tiles of rows (or columns) in separate povray
+    processes and stitch them together into png_name. '''
+
+    if tile_axis == 'rows':
+        start,end,size = '+SR','+ER',height
+    else:
+        start,end,size = '+SC','+EC',width
+    edges = np.linspace(0,size,tiles+1).round().astype(int)
+
+    cleanup = job_dir is None
+    if cleanup:
+        job_dir = tempfile.mkdtemp(prefix='tiles_',dir=os.path.dirname(os.path.abspath(png_name)))
+    job_dir = os.path.abspath(job_dir)
+    os.makedirs(job_dir,exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(png_name))[0]
+    spec = {'pov_file': os.path.abspath(pov_file), 'options': pov_opts, 'tiles': []}
+    try:
+        for n in range(tiles):
+            output = os.path.join(job_dir,'%s_tile%03d.png'%(name,n))
+            for old in [output,output + '.lock',output + '.done']:
+                if os.path.exists(old):
+                    os.remove(old)
+            spec['tiles'].append({'output': output,
+                                  'options': [start + str(edges[n]+1),end + str(edges[n+1])]})
+
+        # publish the job for any other workers, then help render it
+        with open(os.path.join(job_dir,'tiles.json.tmp'),'w') as f:
+            json.dump(spec,f,indent=1)
+        os.replace(os.path.join(job_dir,'tiles.json.tmp'),os.path.join(job_dir,'tiles.json'))
+        render_tiles(job_dir,jobs,threads,quiet)
+
+        # wait for tiles claimed by other workers, rendering any whose worker
+        # has gone (only this process reclaims locks, so removing them is safe)
+        while True:
+            pending = [tile for tile in spec['tiles']
+                       if not os.path.isfile(tile['output'] + '.done')]
+            if not pending:
+                break
+            stale = [tile['output'] + '.lock' for tile in pending
+                     if _tile_lock_stale(tile['output'] + '.lock')]
+            if stale:
+                for lock in stale:
+                    try:
+                        os.remove(lock)
+                    except FileNotFoundError:
+                        pass
+                render_tiles(job_dir,jobs,threads,quiet)
+            else:
+                time.sleep(1)
+
+        status = 0
+        for tile in spec['tiles']:
+            with open(tile['output'] + '.done') as f:
+                status = status or int(f.read() or 1)
+
+        # stitch the tiles together; povray may write either just the rendered
+        # region or a full size image
+        if status == 0:
+            from PIL import Image
+            image = None
+            for n,tile in enumerate(spec['tiles']):
+                part = Image.open(tile['output'])
+                box = (0,edges[n],width,edges[n+1]) if tile_axis == 'rows' else \
+                      (edges[n],0,edges[n+1],height)
+                if part.size == (width,height):
+                    part = part.crop(box)
+                if image is None:
+                    image = Image.new(part.mode,(width,height))
+                image.paste(part,box[:2])
+            image.save(png_name)
+    finally:
+        for tile in spec['tiles']:
+            for f in [tile['output'],tile['output'] + '.lock',tile['output'] + '.done']:
+                if os.path.exists(f):
+                    os.remove(f)
+        if cleanup:
+            shutil.rmtree(job_dir,ignore_errors=True)
+
+    return status
+
+# -----------------------------------------------------------------------------------
+def pov_run(pov_file,width=1024,height=1,res="low",auto_crop=False,threads=None,
+            quiet=False,cache_dir=None,cache_size=2**30,tiles=None,tile_axis='rows',
+            jobs=None,job_dir=None):
+    ''' Render pov_file with povray and return its exit status.
+
+    auto_crop : True to crop the image to its content, or the background
+                color to crop (see image_bbox).
+    threads : limit the number of render threads (+WT).
+    quiet : discard the output of povray.
+    cache_dir : keep the rendered images in this directory and reuse them
+                when the scene (including the local files it includes) and
+                the options (including the povray.ini file) haven't changed.
+    cache_size : the maximum size of the cache in bytes; the least recently
+                 used images are removed first.
+    tiles : for high resolution renders, split the image into this many
+            tiles of rows (or columns if tile_axis='columns') rendered by
+            separate povray processes, jobs at a time, and stitched together.
+    job_dir : a directory for the tiles; if it is on a shared filesystem,
+              render_tiles(job_dir) on other nodes will help with the render
+              (tiles of workers which die are rendered again here).
+    '''
     
     if height == 1:
         height = int(3*width/4.0)
@@ -100,37 +423,238 @@ def pov_run(pov_file,width=1024,height=1,res="low",auto_crop=False):
         pov_opts = ["-p","+H%d"%height,"+W%d"%width,"+Q11","+UA"]
     else:
         pov_opts = ["-p"]
+    povcmd = povray_command()
+    png_name = pov_file.replace('.pov','.png')
 
-    HOME = os.environ['HOME']
-    povcmd = f'{HOME}/local/bin/povray' 
-    povopts = f'{HOME}/.povray/3.7/povray.ini'
+    # a color (hex string or channel values) is the background to crop,
+    # anything else just turns cropping on or off
+    background = None
+    if isinstance(auto_crop,(str,tuple,list,np.ndarray)):
+        auto_crop,background = len(auto_crop) > 0,auto_crop
+    auto_crop = bool(auto_crop)
+
+    # reuse a previous render of the same scene ?
+    if cache_dir:
+        key = _scene_hash(pov_file)
+        key.update(repr((povcmd + pov_opts,auto_crop,background)).encode())
+        # for low resolution renders the size and quality only come from the
+        # options file, so its contents are part of the key
+        for ini in povcmd[1:]:
+            with open(ini,'rb') as f:
+                key.update(f.read())
+        cached = os.path.join(cache_dir,key.hexdigest() + '.png')
+        try:
+            shutil.copyfile(cached,png_name)
+        except FileNotFoundError:
+            # not cached, or evicted by another render in the meantime
+            pass
+        else:
+            try:
+                os.utime(cached)
+            except FileNotFoundError:
+                pass
+            return 0
 
     # render the povray files
-    subprocess.call([povcmd,povopts] + pov_opts + [pov_file])
+    if tiles and res == "high":
+        status = _render_tiled(pov_file,pov_opts,png_name,width,height,tiles,
+                               tile_axis,jobs or tiles,job_dir,threads,quiet)
+    else:
+        if threads:
+            pov_opts.append("+WT%d"%threads)
+        output = subprocess.DEVNULL if quiet else None
+        status = subprocess.call(povcmd + pov_opts + [pov_file],
+                                 stdout=output,stderr=output)
 
     # auto_crop the image ?
-    if auto_crop:
-        png_name = pov_file.replace('.pov','.png')
-        image = Image.open(png_name)
-        cropped = image.crop(image.getbbox())
-        cropped.save(png_name)
+    if auto_crop and status == 0:
+        crop_images([png_name],background)
+
+    if cache_dir and status == 0:
+        os.makedirs(cache_dir,exist_ok=True)
+        # a unique temporary name, as other renders may store the same scene
+        fd,tmp = tempfile.mkstemp(suffix='.tmp',dir=cache_dir)
+        os.close(fd)
+        shutil.copyfile(png_name,tmp)
+        os.replace(tmp,cached)
+        _cache_evict(cache_dir,cache_size)
+
+    return status
+
+# -----------------------------------------------------------------------------------
+RenderResult = namedtuple('RenderResult',['pov_file','status','seconds'])
+
+def render_many(pov_files,jobs=None,threads_per_job=1,quiet=True,**kwargs):
+    ''' Render many .pov files (e.g. the frames of an animation), running
+    up to jobs povray processes at once, each limited to threads_per_job
+    render threads.  By default enough jobs are run to use every core.
+    The remaining options are passed to pov_run.
+
+    Returns a RenderResult (pov_file, exit status, seconds) for each file, in
+    the order given. '''
+
+    if not jobs:
+        jobs = max(1,(os.cpu_count() or 1)//threads_per_job)
+
+    def render(pov_file):
+        start = time.perf_counter()
+        status = pov_run(pov_file,threads=threads_per_job,quiet=quiet,**kwargs)
+        return RenderResult(pov_file,status,time.perf_counter()-start)
+
+    # each job spends its time waiting on its own povray process, so threads
+    # are enough to keep jobs renders going at once
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(render,pov_files))
+
+# -----------------------------------------------------------------------------------
+def _read_ppm(data):
+    ''' Return the width, height and 8-bit rgb pixels of a binary PPM image. '''
+    header = re.match(rb'P6\s+(\d+)\s+(\d+)\s+(\d+)\s',data)
+    if not header:
+        raise ValueError('povray did not produce a PPM image')
+    width,height,maxval = [int(n) for n in header.groups()]
+    pixels = data[header.end():]
+    if len(pixels) != 3*width*height*(2 if maxval > 255 else 1):
+        raise ValueError('the PPM image has %d bytes of pixels, not the %dx%d in its header'
+                         %(len(pixels),width,height))
+    if maxval > 255:
+        pixels = (np.frombuffer(pixels,dtype='>u2')*(255/maxval)).round().astype(np.uint8).tobytes()
+    return width,height,pixels
+
+def render_video(frames,video_file,width=1024,height=1,fps=30,res="high",jobs=1,
+                 threads=None,ffmpeg='ffmpeg',ffmpeg_opts=None,quiet=True):
+    ''' Render the frames of an animation straight into a video: each frame
+    is streamed from povray (+O-) and piped into ffmpeg as raw video, so no
+    images are written to disk.  Returns the exit status of ffmpeg.
+
+    frames : an iterable of .pov file names, or of functions which write the
+             scene of a frame to the File they are given.
+    jobs : the number of frames rendered at once (each with threads threads).
+    ffmpeg_opts : the encoding options (by default H.264 in yuv420p).
+    '''
+
+    if height == 1:
+        height = int(3*width/4.0)
+    pov_opts = ["-p","-D","+H%d"%height,"+W%d"%width,"+FP","+O-"]
+    if res == "high":
+        pov_opts += ["+Q11","+A"]
+    if threads:
+        pov_opts.append("+WT%d"%threads)
+    if ffmpeg_opts is None:
+        # yuv420p needs even dimensions
+        ffmpeg_opts = ['-c:v','libx264','-pix_fmt','yuv420p',
+                       '-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2']
+
+    output = subprocess.DEVNULL if quiet else None
+    video = subprocess.Popen([ffmpeg,'-y','-loglevel','error','-f','rawvideo',
+                              '-pix_fmt','rgb24','-s','%dx%d'%(width,height),
+                              '-r',str(fps),'-i','-'] + ffmpeg_opts + [video_file],
+                             stdin=subprocess.PIPE,stdout=output)
+
+    scene_dir = tempfile.mkdtemp(prefix='frames_')
+    def render(n,frame):
+        pov_file = frame
+        if callable(frame):
+            pov_file = os.path.join(scene_dir,'frame%06d.pov'%n)
+            with File(pov_file) as f:
+                frame(f)
+        rendered = subprocess.run(povray_command() + pov_opts + [pov_file],
+                                  stdout=subprocess.PIPE,stderr=output)
+        if callable(frame):
+            os.remove(pov_file)
+        if rendered.returncode != 0:
+            raise RuntimeError('frame %d could not be rendered'%n)
+        # a frame of another size would corrupt the rest of the raw video
+        frame_width,frame_height,pixels = _read_ppm(rendered.stdout)
+        if (frame_width,frame_height) != (width,height):
+            raise RuntimeError('frame %d is %dx%d, not %dx%d'
+                               %(n,frame_width,frame_height,width,height))
+        return pixels
+
+    # render up to jobs frames ahead while writing them out in order
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            for n,frame in enumerate(frames):
+                pending.append(pool.submit(render,n,frame))
+                if len(pending) > jobs:
+                    video.stdin.write(pending.popleft().result())
+            while pending:
+                video.stdin.write(pending.popleft().result())
+    finally:
+        # ffmpeg may already have exited, e.g. after an error
+        try:
+            video.stdin.close()
+        except BrokenPipeError:
+            pass
+        video.wait()
+        shutil.rmtree(scene_dir,ignore_errors=True)
+
+    return video.returncode
+
+# -----------------------------------------------------------------------------------
+# the items which File(deduplicate=True) declares once and reuses
+DECLARABLE = {"texture","pigment","finish","normal","material","interior"}
+
+def _render(item):
+  """ Return the POV-Ray text for item. """
+  text = io.StringIO()
+  file = File(text,buffer_size=1<<30,header=False)
+  item.write(file)
+  file.flush()
+  return text.getvalue()
 
 # -----------------------------------------------------------------------------------
 class File:
-  def __init__(self,fnam="out.pov",*items):
-    self.file = open(fnam,"w")
+  """ A POV-Ray scene file.
+
+      fnam : a file name, or any open file-like object (io.StringIO, a gzip
+             stream, the stdin of a pipe, ...) which is written to but not
+             closed.
+      buffer_size : lines are collected in memory and written out in one
+             call once they hold at least this many characters; 0 writes
+             every line immediately.
+      header : start the file with the #version and global_settings lines.
+      deduplicate : write each distinct texture, pigment, finish, ... once
+             as a #declare and refer to it from every object that uses it.
+  """
+  def __init__(self,fnam="out.pov",*items,buffer_size=1<<16,header=True,
+               deduplicate=False):
+    if isinstance(fnam,(str,bytes,os.PathLike)):
+      self.file = open(fnam,"w")
+      self.__owner = True
+    else:
+      self.file = fnam
+      self.__owner = False
+    # binary files and streams (pipes, gzip files) are sent encoded text,
+    # anything else is assumed to take str
+    mode = getattr(self.file,"mode","")
+    self.__encode = isinstance(self.file,(io.RawIOBase,io.BufferedIOBase)) or \
+                    (isinstance(mode,str) and "b" in mode)
+    self.__buffer = []
+    self.__buffered = 0
+    self.__buffer_size = buffer_size
     self.__indent = 0
-    self.writeln("#version %3.1f;" % 3.7)
-    self.writeln("global_settings { assumed_gamma 1}")
+    self.__prefix = ""
+    self.__declared = 0
+    # rendered text of each declared item -> its identifier
+    self.deduplicate = deduplicate
+    self.__declarations = {}
+    self.__keys = {}
+    if header:
+      self.writeln("#version %3.1f;" % 3.7)
+      self.writeln("global_settings { assumed_gamma 1}")
     self.write(*items)
   def include(self,name):
     self.writeln( '#include "%s"'%name )
     self.writeln()
   def indent(self):
     self.__indent += 1
+    self.__prefix = "  "*self.__indent
   def dedent(self):
     self.__indent -= 1
     assert self.__indent >= 0
+    self.__prefix = "  "*self.__indent
   def block_begin(self):
     self.writeln( "{" )
     self.indent()
@@ -146,14 +670,98 @@ class File:
         self.include(item)
       else:
         item.write(self)
+  @property
+  def prefix(self):
+    """ The indentation at the current level. """
+    return self.__prefix
+  @property
+  def level(self):
+    """ The current block nesting level (0 at the top level). """
+    return self.__indent
+  def __key(self,item):
+    # items can't change while a top level item is written, so their text
+    # is only rendered once (the item is kept so its id can't be reused)
+    if id(item) not in self.__keys:
+      self.__keys[id(item)] = (item,_render(item))
+    return self.__keys[id(item)][1]
+  def declare(self,item):
+    """ Write a #declare for item and return its identifier.  When
+        deduplicating, an identical item which was already declared is
+        reused. """
+    if type(item) == str:
+      return item
+    if self.deduplicate:
+      key = self.__key(item)
+      if key in self.__declarations:
+        return self.__declarations[key]
+    self.__declared += 1
+    identifier = "%s%d"%(type(item).__name__,self.__declared)
+    self.writeln( "#declare %s ="%identifier )
+    item.write(self)
+    if self.deduplicate:
+      self.__declarations[key] = identifier
+    return identifier
+  def reference(self,item):
+    """ Return the identifier of a declared item identical to item, or
+        None. """
+    if not self.__declarations:
+      return None
+    return self.__declarations.get(self.__key(item))
+  def declare_parts(self,item):
+    """ Declare the textures, pigments, ... used anywhere inside item (but
+        not the ones inside those). """
+    self.__keys = {}
+    for opt in getattr(item,"opts",()):
+      if isinstance(opt,(Item,FunctionItem)):
+        if opt.name in DECLARABLE:
+          self.declare(opt)
+        else:
+          self.declare_parts(opt)
+  def writeraw(self,text):
+    """ Write preformatted text, which includes its own indentation and
+        line endings. """
+    self.__buffer.append(text)
+    self.__buffered += len(text)
+    if self.__buffered >= self.__buffer_size:
+      self.flush()
   def writeln(self,s=""):
-    #print "  "*self.__indent+s
-    self.file.write("  "*self.__indent+s+os.linesep)
+    line = self.__prefix+s+os.linesep
+    self.__buffer.append(line)
+    self.__buffered += len(line)
+    if self.__buffered >= self.__buffer_size:
+      self.flush()
+  def flush(self):
+    """ Write out all buffered lines. """
+    if self.__buffer:
+      text = "".join(self.__buffer)
+      self.file.write(text.encode() if self.__encode else text)
+      self.__buffer = []
+      self.__buffered = 0
   def close(self):
+    if self.file is None:
+      return
+    self.flush()
+    if self.__owner:
       self.file.close()
+    else:
+      self.file.flush()
+    self.file = None
+  def __enter__(self):
+    return self
+  def __exit__(self,*exc):
+    self.close()
+  def __del__(self):
+    # scripts often never close the file, so make sure nothing is lost
+    try:
+      self.close()
+    except Exception:
+      pass
 
 # -----------------------------------------------------------------------------------
 class Vector:
+  """ A POV-Ray vector <x, y, z, ...> of the components in v, a tuple, list
+      or NumPy array. """
+  __slots__ = ("v",)
   def __init__(self,*args):
     if len(args) == 1:
       self.v = args[0]
@@ -162,28 +770,55 @@ class Vector:
   def __str__(self):
     return "<%s>"%(", ".join([str(x)for x in self.v]))
   def __repr__(self):
-    return "Vector(%s)"%self.v
+    return "Vector(%s)"%(self.v,)
   def __mul__(self,other):
+    if isinstance(self.v,np.ndarray):
+      return Vector( self.v*other )
     return Vector( [r*other for r in self.v] )
-  def __rmul__(self,other):
-    return Vector( [r*other for r in self.v] )
+  __rmul__ = __mul__
+
+def _is_vector(value):
+  """ Whether value is written as a vector: a tuple, list or an array with at
+      least one dimension (0-d arrays are scalars). """
+  return isinstance(value,(tuple,list)) or (isinstance(value,np.ndarray) and value.ndim > 0)
 
 # -----------------------------------------------------------------------------------
 class Item:
+  """ A POV-Ray block: name { args opts kwargs }.
+
+      Attributes other than the slots (name, args, opts and kwargs, plus any
+      declared by a subclass) are keywords, i.e. item.color = x is the same
+      as passing color=x and item.color reads kwargs["color"].
+  """
+  __slots__ = ("name","args","opts","kwargs")
+  _slots = frozenset(__slots__)
+  def __init_subclass__(cls,**kwargs):
+    super().__init_subclass__(**kwargs)
+    slots = cls.__dict__.get("__slots__",())
+    cls._slots = cls._slots.union((slots,) if isinstance(slots,str) else slots)
   def __init__(self,name,args=[],opts=[],**kwargs):
-    self.name = name
-    args=list(args)
-    for i in range(len(args)):
-      if type(args[i]) == tuple or type(args[i]) == list:
-        args[i] = Vector(args[i])
-    self.args = args
-    self.opts = opts
-    self.kwargs=kwargs
+    set_ = object.__setattr__
+    set_(self,"name",name)
+    set_(self,"args",[Vector(arg) if _is_vector(arg) else arg
+                      for arg in args])
+    set_(self,"opts",opts)
+    set_(self,"kwargs",kwargs)
   def append(self, item):
     self.opts.append( item )
   def write(self, file):
+    if file.deduplicate:
+      if self.name in DECLARABLE:
+        identifier = file.reference(self)
+        if identifier:
+          file.writeln( "%s { %s }"%(self.name,identifier) )
+          return
+      elif file.level == 0:
+        file.declare_parts(self)
     file.writeln( self.name )
     file.block_begin()
+    self.write_contents(file)
+    file.block_end()
+  def write_contents(self, file):
     if self.args:
       file.writeln( ", ".join([str(arg) for arg in self.args]) )
     for opt in self.opts:
@@ -192,45 +827,66 @@ class Item:
       else:
         file.writeln( str(opt) )
     for key,val in self.kwargs.items():
-      if type(val)==tuple or type(val)==list:
+      if _is_vector(val):
         # AGD added on 2017-10-09 to deal with rgbt tuples
         # there is probably a better way to do this
         rgbt = False
         if len(val) == 4: 
             rgbt = True
-        val = Vector(*val)
+        val = Vector(val)
         if key == "color" and rgbt:
             key += " rgbt"
         file.writeln( "%s %s"%(key,val) )
       else:
         file.writeln( "%s %s"%(key,val) )
-    file.block_end()
   def __setattr__(self,name,val):
-    self.__dict__[name]=val
-    if name not in ["kwargs","args","opts","name"]:
-      self.__dict__["kwargs"][name]=val
+    if name in self._slots:
+      object.__setattr__(self,name,val)
+    else:
+      self.kwargs[name] = val
+  def __getattr__(self,name):
+    # only called for names which aren't slots or class attributes
+    if name == "kwargs" or name.startswith("__"):
+      raise AttributeError(name)
+    try:
+      return self.kwargs[name]
+    except KeyError:
+      raise AttributeError("%r has no attribute or keyword %r"%(type(self).__name__,name)) from None
+  def __delattr__(self,name):
+    if name in self._slots:
+      object.__delattr__(self,name)
+    else:
+      try:
+        del self.kwargs[name]
+      except KeyError:
+        raise AttributeError(name) from None
   def __setitem__(self,i,val):
     if i < len(self.args):
       self.args[i] = val
     else:
-      i += len(args)
-      if i < len(self.opts):
-        self.opts[i] = val
-  def __getitem__(self,i,val):
+      self.opts[i - len(self.args)] = val
+  def __getitem__(self,i):
     if i < len(self.args):
       return self.args[i]
     else:
-      i += len(args)
-      if i < len(self.opts):
-        return self.opts[i]
+      return self.opts[i - len(self.args)]
 
 # -----------------------------------------------------------------------------------
 class FunctionItem:
+  """ A block whose args are written verbatim, e.g. function { x*x }.  Keyword
+      attributes work as for Item. """
+  __slots__ = ("name","args","opts","kwargs")
+  _slots = frozenset(__slots__)
+  def __init_subclass__(cls,**kwargs):
+    super().__init_subclass__(**kwargs)
+    slots = cls.__dict__.get("__slots__",())
+    cls._slots = cls._slots.union((slots,) if isinstance(slots,str) else slots)
   def __init__(self,name,args="",opts=[],**kwargs):
-    self.name = name
-    self.args = args
-    self.opts = opts
-    self.kwargs=kwargs
+    set_ = object.__setattr__
+    set_(self,"name",name)
+    set_(self,"args",args)
+    set_(self,"opts",opts)
+    set_(self,"kwargs",kwargs)
   def append(self, item):
     self.opts.append( item )
   def write(self, file):
@@ -244,86 +900,99 @@ class FunctionItem:
       else:
         file.writeln( str(opt) )
     for key,val in self.kwargs.items():
-      if type(val)==tuple or type(val)==list:
-        val = Vector(*val)
+      if _is_vector(val):
+        val = Vector(val)
         file.writeln( "%s %s"%(key,val) )
       else:
         file.writeln( "%s %s"%(key,val) )
     file.block_end()
-  def __setattr__(self,name,val):
-    self.__dict__[name]=val
-    if name not in ["kwargs","args","opts","name"]:
-      self.__dict__["kwargs"][name]=val
+  __setattr__ = Item.__setattr__
+  __getattr__ = Item.__getattr__
+  __delattr__ = Item.__delattr__
 
 # -----------------------------------------------------------------------------------
 class Texture(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"texture",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Pigment(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"pigment",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Finish(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"finish",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Image_Map(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"image_map",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Normal(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"normal",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Camera(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"camera",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class LightSource(Item):
+  __slots__ = ()
   def __init__(self,v,*opts,**kwargs):
     Item.__init__(self,"light_source",(Vector(v),),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Background(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"background",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Box(Item):
+  __slots__ = ()
   def __init__(self,v1,v2,*opts,**kwargs):
     Item.__init__(self,"box",(v1,v2),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Cylinder(Item):
+  __slots__ = ()
   def __init__(self,v1,v2,r,*opts,**kwargs):
     " opts: open "
     Item.__init__(self,"cylinder",(v1,v2,r),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Plane(Item):
+  __slots__ = ()
   def __init__(self,v,r,*opts,**kwargs):
     Item.__init__(self,"plane",(v,r),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Torus(Item):
+  __slots__ = ()
   def __init__(self,r1,r2,*opts,**kwargs):
     Item.__init__(self,"torus",(r1,r2),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Cone(Item):
+  __slots__ = ()
   def __init__(self,v1,r1,v2,r2,*opts,**kwargs):
     " opts: open "
     Item.__init__(self,"cone", (v1,r1,v2,r2),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Sphere(Item):
+  __slots__ = ()
   def __init__(self,v,r,*opts,**kwargs):
     Item.__init__(self,"sphere",(v,r),opts,**kwargs)
 
@@ -331,41 +1000,356 @@ class Sphere(Item):
 #   def __init__(self,v,r,*opts,**kwargs):
 #     Item.__init__(self,"sphere",(v,r),opts,**kwargs)
 
+# -----------------------------------------------------------------------------------
+def _format_rows(fmt,*columns,chunk_size=100000):
+  """ Yield blocks of text with fmt applied to each row of the columns,
+      formatting a whole chunk of rows at once. """
+  columns = [np.asarray(c,dtype=float) for c in columns]
+  # an explicit column count, so columns without any rows work too
+  data = np.column_stack([c if c.ndim == 2 else c.reshape(-1,1) for c in columns])
+  for start in range(0,len(data),chunk_size):
+    rows = data[start:start+chunk_size]
+    yield (fmt*len(rows)) % tuple(rows.ravel().tolist())
+
+# -----------------------------------------------------------------------------------
+class PrimitiveArray(Item):
+  """ A union of many primitives of the same kind stored as arrays, which are
+      written in bulk without creating an Item for each one.
+
+      geometry : format of the primitive and the columns it is filled from.
+      colors : optional (N,3) rgb or (N,4) rgbt array of colors in [0,1].
+      texture : shared by every primitive; with colors it is declared once
+                and each primitive only adds its own pigment.
+      opts, kwargs : applied to the union.
+
+      Numbers are written with number_format, 9 significant digits by
+      default ("%.17g" keeps the full double precision).
+  """
+  __slots__ = ("geometry","columns","colors","texture")
+  number_format = "%.9g"
+  def __init__(self,geometry,columns,*opts,colors=None,texture=None,**kwargs):
+    opts = list(opts)
+    if texture is not None and colors is None:
+      opts.insert(0,texture)
+      texture = None
+    Item.__init__(self,"union",(),opts,**kwargs)
+    self.geometry = geometry
+    self.columns = [np.asarray(c,dtype=float) for c in columns]
+    self.colors = None if colors is None else np.asarray(colors,dtype=float)
+    self.texture = texture
+  def __len__(self):
+    return len(self.columns[0])
+  def write_contents(self, file):
+    texture = None if self.texture is None else file.declare(self.texture)
+    fmt = self.geometry.replace("%g",self.number_format)
+    columns = list(self.columns)
+    if self.colors is not None:
+      color = "color rgbt <%g, %g, %g, %g>" if self.colors.shape[-1] == 4 else "color rgb <%g, %g, %g>"
+      color = color.replace("%g",self.number_format)
+      if texture:
+        fmt += " texture { %s pigment { %s } }"%(texture,color)
+      else:
+        fmt += " pigment { %s }"%color
+      columns.append(self.colors)
+    fmt = file.prefix + fmt + " }" + os.linesep
+    for block in _format_rows(fmt,*columns):
+      file.writeraw(block)
+    Item.write_contents(self,file)
+
+# -----------------------------------------------------------------------------------
+class SphereArray(PrimitiveArray):
+  """ Spheres with (N,3) centers and radii (an (N,) array or a single value). """
+  __slots__ = ()
+  def __init__(self,centers,radii,*opts,colors=None,texture=None,**kwargs):
+    centers = np.asarray(centers,dtype=float).reshape(-1,3)
+    radii = np.broadcast_to(np.asarray(radii,dtype=float),(len(centers),))
+    PrimitiveArray.__init__(self,"sphere { <%g, %g, %g>, %g",(centers,radii),*opts,
+                            colors=colors,texture=texture,**kwargs)
+
+# -----------------------------------------------------------------------------------
+class CylinderArray(PrimitiveArray):
+  """ Cylinders from (N,3) starts to (N,3) ends with radii (an (N,) array or a
+      single value). """
+  __slots__ = ()
+  def __init__(self,starts,ends,radii,*opts,colors=None,texture=None,**kwargs):
+    starts = np.asarray(starts,dtype=float).reshape(-1,3)
+    ends = np.asarray(ends,dtype=float).reshape(-1,3)
+    radii = np.broadcast_to(np.asarray(radii,dtype=float),(len(starts),))
+    PrimitiveArray.__init__(self,"cylinder { <%g, %g, %g>, <%g, %g, %g>, %g",
+                            (starts,ends,radii),*opts,colors=colors,texture=texture,
+                            **kwargs)
+
+# -----------------------------------------------------------------------------------
+class Mesh2(Item):
+  """ A triangle mesh from a (V,3) array of vertices, an (F,3) array of
+      vertex indices for each face and optionally a (V,3) array of vertex
+      normals (for smooth shading, keyword only).  Vectors are written with
+      number_format, like PrimitiveArray. """
+  __slots__ = ("vertices","faces","normals")
+  number_format = PrimitiveArray.number_format
+  def __init__(self,vertices,faces,*opts,normals=None,**kwargs):
+    Item.__init__(self,"mesh2",(),opts,**kwargs)
+    self.vertices = np.asarray(vertices,dtype=float).reshape(-1,3)
+    self.faces = np.asarray(faces,dtype=int).reshape(-1,3)
+    self.normals = None if normals is None else np.asarray(normals,dtype=float).reshape(-1,3)
+  def write_vectors(self, file, name, vectors, fmt):
+    file.writeln( name )
+    file.block_begin()
+    file.writeln( "%d,"%len(vectors) )
+    fmt = file.prefix + "<%s, %s, %s>,"%((fmt,)*3) + os.linesep
+    blocks = list(_format_rows(fmt,vectors))
+    if blocks:
+      # no comma after the last vector
+      blocks[-1] = blocks[-1][:-len(os.linesep)-1] + os.linesep
+    for block in blocks:
+      file.writeraw(block)
+    file.block_end()
+  def write_contents(self, file):
+    self.write_vectors(file,"vertex_vectors",self.vertices,self.number_format)
+    if self.normals is not None:
+      self.write_vectors(file,"normal_vectors",self.normals,self.number_format)
+    self.write_vectors(file,"face_indices",self.faces,"%d")
+    Item.write_contents(self,file)
+
+# -----------------------------------------------------------------------------------
+def isosurface_mesh(density,level,*opts,spacing=(1,1,1),origin=(0,0,0),**kwargs):
+  """ Extract the surface density == level from a 3D grid with marching cubes
+      (requires scikit-image) and return it as a Mesh2, so the surface is
+      found once rather than by POV-Ray on every render.
+
+      spacing : the grid spacing along each axis.
+      origin : the position of density[0,0,0].
+  """
+  try:
+    from skimage.measure import marching_cubes
+  except ImportError:
+    raise ImportError("isosurface_mesh requires scikit-image") from None
+
+  vertices,faces,normals,_ = marching_cubes(np.asarray(density),level,spacing=spacing)
+  return Mesh2(vertices + np.asarray(origin),faces,*opts,normals=normals,**kwargs)
+
 # -----------------------------------------------------------------------------------
 class Union(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"union",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Intersection(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"intersection",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Difference(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"difference",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Merge(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"merge",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Object(Item):
+  __slots__ = ()
   def __init__(self, *opts, **kwargs):
       Item.__init__(self, "object", (), opts, **kwargs)
 
 # -----------------------------------------------------------------------------------
 class Isosurface(Item):
+  __slots__ = ()
   def __init__(self,*opts,**kwargs):
     Item.__init__(self,"isosurface",(),opts,**kwargs)
 
 # -----------------------------------------------------------------------------------
 class Function(FunctionItem):
+    __slots__ = ()
     def __init__(self, f, *opts, **kwargs):
         FunctionItem.__init__(self, "function", (f),opts,**kwargs)
 
+# -----------------------------------------------------------------------------------
+# version of the schema written by save_scene
+SCENE_VERSION = 1
+
+def _scene_classes():
+  """ The item classes save_scene and load_scene accept: pypov's own. """
+  return {name: cls for name,cls in globals().items()
+          if isinstance(cls,type) and issubclass(cls,(Item,FunctionItem))
+          and cls.__module__ == __name__}
+
+def save_scene(filename,*items,compress=False):
+  """ Save the items of a scene (anything File.write accepts) in a binary
+      form which load_scene reads back.
+
+      filename : a .npz archive, or otherwise a directory holding schema.json
+                 and a .npy file for each array, which load_scene can
+                 memory-map.
+      compress : compress the .npz archive.
+
+      The arrays of SphereArray, CylinderArray, Mesh2, ... are stored as they
+      are and the numeric vectors of all other items are packed into one
+      float and one integer array, so only the tree of items is JSON.  Other
+      numeric types (e.g. float32) keep their dtype, so the reloaded scene
+      is written as the same text.  Items used in several places are stored
+      once.
+  """
+  classes = _scene_classes()
+  arrays = {}
+  objects = []
+  numbers = {}
+  packed = {"vf": [], "vi": []}
+
+  def encode(val):
+    if isinstance(val,np.generic):
+      if val.dtype.kind not in "biuf":
+        raise TypeError("save_scene can't save %s values"%type(val).__name__)
+      return {"scalar": [val.dtype.str,val.item()]}
+    if val is None or isinstance(val,(bool,int,float,str)):
+      return val
+    if isinstance(val,np.ndarray):
+      if val.dtype.hasobject:
+        raise TypeError("save_scene can't save arrays of Python objects")
+      key = "a%d"%len(arrays)
+      arrays[key] = val
+      return {"array": key}
+    if isinstance(val,Vector):
+      v = val.v
+      # only float64 and int arrays are written the same as Python numbers
+      if isinstance(v,np.ndarray) and v.ndim == 1 and (v.dtype == np.float64
+          or (v.dtype.kind in "iu" and np.can_cast(v.dtype,np.int64))):
+        v = v.tolist()
+      if isinstance(v,(tuple,list)) and v:
+        kinds = {type(c) for c in v}
+        if kinds == {float} or kinds == {int}:
+          key = "vf" if kinds == {float} else "vi"
+          packed[key].extend(v)
+          return {key: [len(packed[key]) - len(v), len(v)]}
+      return {"vector": encode(val.v)}
+    if isinstance(val,(Item,FunctionItem)):
+      if id(val) in numbers:
+        return {"item": numbers[id(val)]}
+      cls = type(val)
+      if classes.get(cls.__name__) is not cls:
+        raise TypeError("save_scene can only save pypov's own items, not %s"%cls.__name__)
+      number = numbers[id(val)] = len(objects)
+      objects.append(None)
+      slots = {}
+      for slot in sorted(cls._slots):
+        try:
+          slots[slot] = encode(object.__getattribute__(val,slot))
+        except AttributeError:
+          pass
+      objects[number] = [cls.__name__,slots]
+      return {"item": number}
+    if isinstance(val,tuple):
+      return [encode(x) for x in val]
+    if isinstance(val,list):
+      return {"list": [encode(x) for x in val]}
+    if isinstance(val,dict) and all(isinstance(k,str) for k in val):
+      return {"dict": {k: encode(x) for k,x in val.items()}}
+    raise TypeError("save_scene can't save %s values"%type(val).__name__)
+
+  scene = [encode(item) for item in items]
+  schema = {"version": SCENE_VERSION, "objects": objects, "scene": scene}
+  arrays["vf"] = np.array(packed["vf"],dtype=float)
+  arrays["vi"] = np.array(packed["vi"],dtype=np.int64)
+
+  schema = json.dumps(schema,separators=(",",":"))
+  if str(filename).endswith(".npz"):
+    savez = np.savez_compressed if compress else np.savez
+    savez(filename,schema=np.frombuffer(schema.encode(),dtype=np.uint8),**arrays)
+  else:
+    os.makedirs(filename,exist_ok=True)
+    for key,val in arrays.items():
+      np.save(os.path.join(filename,key + ".npy"),val,allow_pickle=False)
+    # the schema is written last, so it never refers to missing arrays
+    schema_file = os.path.join(filename,"schema.json")
+    with open(schema_file + ".tmp","w") as f:
+      f.write(schema)
+    os.replace(schema_file + ".tmp",schema_file)
+
+def load_scene(filename,select=None,mmap_mode=None):
+  """ Load the items saved by save_scene, as a list.
+
+      select : the indices of the top level items to load; only the items
+               and arrays they use are read.
+      mmap_mode : memory-map the arrays of a scene saved to a directory (see
+                  numpy.load); 'c' allows changing them without touching
+                  the files.
+  """
+  classes = _scene_classes()
+  loaded = {}
+  items = {}
+
+  if os.path.isdir(filename):
+    with open(os.path.join(filename,"schema.json")) as f:
+      schema = json.load(f)
+    def read(key):
+      return np.load(os.path.join(filename,key + ".npy"),mmap_mode=mmap_mode,
+                     allow_pickle=False)
+    archive = None
+  else:
+    archive = np.load(filename,allow_pickle=False)
+    schema = json.loads(archive["schema"].tobytes())
+    read = archive.__getitem__
+
+  if schema.get("version") != SCENE_VERSION:
+    raise ValueError("%s: unsupported scene version %r"%(filename,schema.get("version")))
+  objects = schema["objects"]
+
+  def array(key):
+    if key not in loaded:
+      loaded[key] = read(key)
+      if key in ("vf","vi"):
+        loaded[key] = loaded[key].tolist()
+    return loaded[key]
+
+  def decode(val):
+    if isinstance(val,list):
+      return tuple([decode(x) for x in val])
+    if not isinstance(val,dict):
+      return val
+    (tag,val), = val.items()
+    if tag == "item":
+      if val not in items:
+        name,slots = objects[val]
+        cls = classes.get(name)
+        if cls is None:
+          raise ValueError("%s: unknown item class %r"%(filename,name))
+        item = items[val] = cls.__new__(cls)
+        for slot,x in slots.items():
+          if slot not in cls._slots:
+            raise ValueError("%s: %s has no slot %r"%(filename,cls.__name__,slot))
+          object.__setattr__(item,slot,decode(x))
+      return items[val]
+    if tag in ("vf","vi"):
+      start,length = val
+      return Vector(tuple(array(tag)[start:start + length]))
+    if tag == "vector":
+      return Vector(decode(val))
+    if tag == "scalar":
+      dtype,x = val
+      return np.dtype(dtype).type(x)
+    if tag == "array":
+      return array(val)
+    if tag == "list":
+      return [decode(x) for x in val]
+    if tag == "dict":
+      return {k: decode(x) for k,x in val.items()}
+    raise ValueError("%s: unknown value %r"%(filename,tag))
+
+  scene = schema["scene"]
+  if select is not None:
+    scene = [scene[i] for i in select]
+  try:
+    return [decode(item) for item in scene]
+  finally:
+    if archive is not None:
+      archive.close()
+
 
 # -----------------------------------------------------------------------------------
 # -----------------------------------------------------------------------------------
@@ -385,7 +1369,7 @@ def tutorial31():
 def spiral():
   " Fibonacci spiral "
   gamma = (sqrt(5)-1)/2
-  file = File()
+  file = File(deduplicate=True)
   Camera(location=(0,0,-128), look_at=(0,0,0)).write(file)
   LightSource((100,100,-100), color=(1,1,1)).write(file)
   LightSource((150,150,-100), color=(0,0,0.3)).write(file)
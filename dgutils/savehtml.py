@@ -5,35 +5,327 @@ Export Jupyter notebooks as html files if the .ipynb has changed.
 '''
 
 import os
+import json
+import time
+import hashlib
 import datetime
 import subprocess
+import importlib.util
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# manifest of the notebook hashes used for the html files in an output directory
+CACHE_FILE = '.dgutils-cache.json'
 
 def modified(filename):
     '''Get the modification time of a file. '''
     t = os.path.getmtime(filename)
     return datetime.datetime.fromtimestamp(t)
 
-def save():
-    ''' Save all Jupyter notebooks as html files. '''
+def notebook_hash(notebook):
+    '''Return a hash of the cells of a notebook, ignoring volatile metadata.
+       Returns None if the notebook can't be read.'''
+    try:
+        with open(notebook, encoding='utf-8') as f:
+            cells = json.load(f).get('cells', [])
+    except (OSError, ValueError):
+        return None
 
-    # Check if we an html output directory, if not, make it
-    if not os.path.isdir('html'):
-        os.mkdir('html')
+    keys = ['cell_type', 'source', 'outputs', 'execution_count']
+    cells = [{key: cell.get(key) for key in keys} for cell in cells]
+    return hashlib.sha256(json.dumps(cells, sort_keys=True).encode()).hexdigest()
 
-    # Get the list of all notebooks
-    notebooks = [f for f in os.listdir('.') if os.path.isfile(f)]
+def nbconvert_version():
+    '''Return the installed version of nbconvert (None if unknown).'''
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version('nbconvert')
+    except PackageNotFoundError:
+        return None
+
+def load_cache(output_dir='html'):
+    '''Load the notebook hashes for output_dir.  The cache is discarded if
+       it is invalid or was written with a different version of nbconvert.'''
+    try:
+        with open(os.path.join(output_dir, CACHE_FILE)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+
+    version = nbconvert_version()
+    if (cache.get('nbconvert') != version
+            or not isinstance(cache.get('notebooks'), dict)):
+        cache = {'nbconvert': version, 'notebooks': {}}
+    return cache
+
+def write_cache(cache, output_dir='html'):
+    '''Write the notebook hashes for output_dir.'''
+    filename = os.path.join(output_dir, CACHE_FILE)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+# html exporter shared by every notebook converted in this process
+_exporter = None
+
+def get_exporter():
+    '''Return the nbconvert html exporter, creating it on first use with
+       the same configuration (jupyter_nbconvert_config) as the jupyter
+       nbconvert command.'''
+    global _exporter
+    if _exporter is None:
+        from nbconvert import HTMLExporter
+        from nbconvert.nbconvertapp import NbConvertApp
+        app = NbConvertApp()
+        app.load_config_file()
+        _exporter = HTMLExporter(config=app.config)
+    return _exporter
+
+def convert(notebook, output_dir='html', backend=None):
+    '''Convert a notebook to an html file in output_dir.
+
+       backend : 'nbconvert' to convert in this process reusing a single
+                 exporter, or 'subprocess' to run jupyter nbconvert.  By
+                 default nbconvert is used if it can be imported.
+    '''
+    if backend is None:
+        backend = 'nbconvert' if importlib.util.find_spec('nbconvert') else 'subprocess'
+
+    if backend == 'subprocess':
+        return subprocess.call(['jupyter','nbconvert','--to','html',
+                                '--output-dir',output_dir,notebook])
 
-    # keep only the .ipynb files
+    try:
+        body,_ = get_exporter().from_filename(notebook)
+    except Exception as e:
+        print(f'Notebook: {notebook} could not be converted: {e}\n')
+        return 1
+
+    name = os.path.splitext(os.path.basename(notebook))[0]
+    with open(os.path.join(output_dir, name + '.html'), 'w', encoding='utf-8') as f:
+        f.write(body)
+    return 0
+
+def build(notebooks, output_dir='html', jobs=1, backend=None):
+    '''Convert the notebooks whose content has changed since their html
+       file was generated.  Returns the notebooks that were converted.
+
+       notebooks : paths of .ipynb files, all stored in the same directory.
+       output_dir : the directory the html files are written to.
+       jobs : the number of notebooks to convert at the same time.
+       backend : how to convert the notebooks, see convert().
+    '''
+
+    # Check if we an html output directory, if not, make it
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    # keep only the .ipynb files whose content has changed since their html
+    # file was generated
+    cache = load_cache(output_dir)
+    hashes = {}
+    stale = []
     for notebook in notebooks:
         # get the name and extension
-        name,extension = os.path.splitext(notebook)
+        key = os.path.basename(notebook)
+        name,extension = os.path.splitext(key)
 
         # check if we have a .ipynb file
         if extension == '.ipynb':
+            html = os.path.join(output_dir, name + '.html')
+            hashes[key] = notebook_hash(notebook)
+
+            # html files made before there was a cache are kept if they are
+            # newer than the notebook
+            if key not in cache['notebooks'] and os.path.isfile(html) \
+                    and modified(notebook) <= modified(html):
+                cache['notebooks'][key] = hashes[key]
+
+            # check if we need to regenerate the html file
+            if not os.path.isfile(html) or hashes[key] is None or \
+                    hashes[key] != cache['notebooks'].get(key):
+                stale.append(notebook)
+
+    # convert the notebooks, writing directly into the html directory
+    convert_ = partial(convert, output_dir=output_dir, backend=backend)
+    if jobs > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            status = list(pool.map(convert_, stale))
+    else:
+        status = [convert_(notebook) for notebook in stale]
+
+    # only remember the notebooks which were converted successfully
+    converted = [notebook for notebook,code in zip(stale, status) if code == 0]
+    for notebook in converted:
+        key = os.path.basename(notebook)
+        cache['notebooks'][key] = hashes[key]
+    write_cache(cache, output_dir)
+
+    return converted
+
+def save(jobs=1, backend=None):
+    ''' Save all Jupyter notebooks as html files.
+
+        jobs : the number of notebooks to convert at the same time.
+        backend : how to convert the notebooks, see convert().
+    '''
+
+    # Get the list of all notebooks
+    notebooks = [f for f in os.listdir('.') if os.path.isfile(f)]
+    build(notebooks, 'html', jobs, backend)
+
+# -----------------------------------------------------------------------------
+def _list_dir(path):
+    '''Return the notebooks and the subdirectories to watch in path.  The
+       html output directories and hidden directories (such as
+       .ipynb_checkpoints) are skipped.'''
+    notebooks,subdirs = set(),set()
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return notebooks,subdirs
+
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir() and entry.name != 'html':
+            subdirs.add(entry.path)
+        elif entry.is_file() and entry.name.endswith('.ipynb'):
+            notebooks.add(entry.path)
+    return notebooks,subdirs
+
+def find_notebooks(root='.', recursive=True):
+    '''Return a dictionary of directory -> set of notebooks under root.'''
+    index = {}
+    dirs = [root]
+    while dirs:
+        path = dirs.pop()
+        index[path],subdirs = _list_dir(path)
+        if recursive:
+            dirs.extend(subdirs)
+    return index
+
+def _inotify_changes(index, recursive):
+    '''Return a function that waits for changes to the notebooks in index
+       using inotify, or None if inotify_simple isn't available.'''
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+
+    inotify = INotify()
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    watches = {inotify.add_watch(path, mask): path for path in index}
+
+    def changes(timeout):
+        changed = set()
+        for event in inotify.read(timeout=int(1000*timeout)):
+            path = os.path.join(watches.get(event.wd, ''), event.name)
+            if event.mask & flags.ISDIR:
+                # watch and index any new directories
+                if recursive and os.path.basename(path) != 'html' \
+                        and not event.name.startswith('.'):
+                    for subdir,notebooks in find_notebooks(path).items():
+                        watches[inotify.add_watch(subdir, mask)] = subdir
+                        index[subdir] = notebooks
+                        changed |= notebooks
+            elif path.endswith('.ipynb') and not event.name.startswith('.'):
+                index.setdefault(os.path.dirname(path), set()).add(path)
+                changed.add(path)
+        return changed
+
+    return changes
+
+def _poll_changes(index, recursive):
+    '''Return a function that waits for changes to the notebooks in index
+       by polling their modification times.  Only directories which have
+       themselves changed are listed again.'''
+
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    mtimes = {path: mtime(path) for path in index}
+    mtimes.update({nb: mtime(nb) for notebooks in index.values() for nb in notebooks})
+
+    def changes(timeout):
+        time.sleep(timeout)
+        changed = set()
+
+        # pick up new notebooks and directories
+        for path in list(index):
+            if mtime(path) != mtimes[path]:
+                mtimes[path] = mtime(path)
+                index[path],subdirs = _list_dir(path)
+                if not recursive:
+                    continue
+                for subdir in subdirs - set(index):
+                    for subdir_,notebooks in find_notebooks(subdir).items():
+                        index[subdir_] = notebooks
+                        mtimes[subdir_] = mtime(subdir_)
+
+        # and any notebooks which have been modified
+        for notebooks in index.values():
+            for notebook in notebooks:
+                t = mtime(notebook)
+                if t != mtimes.get(notebook):
+                    mtimes[notebook] = t
+                    changed.add(notebook)
+        return changed
+
+    return changes
+
+def watch(root='.', recursive=True, settle=2.0, interval=1.0, jobs=1,
+          backend=None, poll=False):
+    '''Keep the html files of all notebooks under root up to date,
+       converting a notebook once it hasn't changed for settle seconds.
+       Runs until interrupted.
+
+       recursive : also watch the subdirectories of root.
+       settle : seconds a notebook must be unchanged before it is converted.
+       interval : seconds between checks when polling.
+       jobs, backend : see build().
+       poll : poll for changes even if inotify is available.
+    '''
+
+    index = find_notebooks(root, recursive)
+    for path,notebooks in index.items():
+        if notebooks:
+            build(notebooks, os.path.join(path, 'html'), jobs, backend)
+
+    changes = None if poll else _inotify_changes(index, recursive)
+    if changes is None:
+        changes = _poll_changes(index, recursive)
+
+    # the time each notebook was last seen to change
+    pending = {}
+    try:
+        while True:
+            timeout = interval
+            if pending:
+                timeout = max(0, min(timeout, min(pending.values()) + settle - time.monotonic()))
+
+            changed = changes(timeout)
+            now = time.monotonic()
+            for notebook in changed:
+                pending[notebook] = now
 
-            # check if we need to regenerate the html file 
-            html = name + '.html'
-            if not os.path.isfile('html/%s'%html) or (modified(notebook) > modified('html/%s'%html)):
-                subprocess.call(['jupyter','nbconvert','--to','html',notebook])
-                subprocess.call(['mv',html,'html/%s'%html])
-                
+            # convert the notebooks whose edits have settled
+            now = time.monotonic()
+            ready = [nb for nb,t in pending.items() if now - t >= settle]
+            by_dir = {}
+            for notebook in ready:
+                del pending[notebook]
+                if os.path.isfile(notebook):
+                    by_dir.setdefault(os.path.dirname(notebook), []).append(notebook)
+            for path,notebooks in by_dir.items():
+                build(notebooks, os.path.join(path, 'html'), jobs, backend)
+    except KeyboardInterrupt:
+        pass
@@ -12,13 +12,12 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type='text/markdown',
     install_requires=['numpy','scipy','matplotlib','pillow'],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     url='https://github.com/DelMaestroGroup/dgutils',
     author='Adrian Del Maestro',
     author_email='adrian@delmaestro.org',
     classifiers=[
    'License :: OSI Approved :: MIT License',
-   'Programming Language :: Python :: 3.6',
    'Programming Language :: Python :: 3.7',
    'Topic :: Scientific/Engineering :: Physics']
 )